@@ -0,0 +1,511 @@
+#
+# This file is part of MiSTeX-Boards.
+#
+# Copyright (c) 2023 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+from functools import reduce
+from operator import or_
+
+from migen import *
+from migen.genlib.fifo import SyncFIFO, SyncFIFOBuffered
+from migen.genlib.cdc import MultiReg
+
+from litex.gen import LiteXModule
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.avalon import AvalonMMInterface
+
+# Burst Queue --------------------------------------------------------------------------------------
+
+class _BurstQueue(LiteXModule):
+    """FIFO of burst descriptors (address, burstcount) held in registers, so that every pending
+    burst can be compared against the address range of an incoming request."""
+    def __init__(self, adr_width, depth):
+        assert depth & (depth - 1) == 0
+        self.we               = Signal()
+        self.writable         = Signal()
+        self.din_address      = Signal(adr_width)
+        self.din_burstcount   = Signal(8)
+
+        self.re               = Signal()
+        self.readable         = Signal()
+        self.dout_address     = Signal(adr_width)
+        self.dout_burstcount  = Signal(8)
+
+        self.level            = Signal(max=depth + 1)
+
+        self.check_address    = Signal(adr_width)
+        self.check_burstcount = Signal(8)
+        self.check_hit        = Signal()
+
+        # # #
+
+        address    = Array(Signal(adr_width)     for _ in range(depth))
+        end        = Array(Signal(adr_width + 1) for _ in range(depth))
+        burstcount = Array(Signal(8)             for _ in range(depth))
+        valid      = Array(Signal()              for _ in range(depth))
+
+        produce = Signal(max=depth)
+        consume = Signal(max=depth)
+
+        do_write = Signal()
+        do_read  = Signal()
+        self.comb += [
+            self.writable.eq(self.level != depth),
+            self.readable.eq(self.level != 0),
+            do_write.eq(self.we & self.writable),
+            do_read.eq(self.re & self.readable),
+            self.dout_address.eq(address[consume]),
+            self.dout_burstcount.eq(burstcount[consume]),
+        ]
+        self.sync += [
+            If(do_write,
+                address[produce].eq(self.din_address),
+                end[produce].eq(self.din_address + self.din_burstcount),
+                burstcount[produce].eq(self.din_burstcount),
+                valid[produce].eq(1),
+                produce.eq(produce + 1),
+            ),
+            If(do_read,
+                valid[consume].eq(0),
+                consume.eq(consume + 1),
+            ),
+            If(do_write & ~do_read,
+                self.level.eq(self.level + 1),
+            ).Elif(do_read & ~do_write,
+                self.level.eq(self.level - 1),
+            ),
+        ]
+
+        # Two bursts overlap when each one starts before the other one ends.
+        check_end = Signal(adr_width + 1)
+        self.comb += [
+            check_end.eq(self.check_address + self.check_burstcount),
+            self.check_hit.eq(reduce(or_, [
+                valid[i] & (self.check_address < end[i]) & (address[i] < check_end)
+                for i in range(depth)])),
+        ]
+
+# Avalon Memory Scheduler --------------------------------------------------------------------------
+
+class AvalonMemScheduler(LiteXModule):
+    """Splits Avalon-MM traffic into a read and a write queue and batches the writes.
+
+    Reads and writes are acknowledged as soon as they are queued. The scheduler serves reads until
+    ``wq_hi`` write data beats are pending (or no read is waiting) and then drains whole write
+    bursts until the write queue is down to ``wq_lo`` beats again, so the DDR3 bus is turned around
+    once per batch instead of once per write. Reads may overtake queued writes, but never one they
+    overlap with, and a write overlapping a queued read is held back until that read was issued.
+    """
+    def __init__(self, adr_width, data_width, depth=256, wq_hi=192, wq_lo=64, wq_depth=8, rq_depth=4):
+        assert 0 <= wq_lo < wq_hi <= depth
+        self.slave  = slave  = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+        self.master = master = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+
+        # # #
+
+        # Read bursts, write bursts and write data.
+        self.rq_fifo  = rq_fifo  = _BurstQueue(adr_width, rq_depth)
+        self.wq_fifo  = wq_fifo  = _BurstQueue(adr_width, wq_depth)
+        self.wdata    = wdata    = SyncFIFOBuffered(data_width + data_width//8, depth)
+
+        # Slave side: queue read and write bursts, write commands go along with their first beat.
+        wr_beats  = Signal(8)
+        wr_first  = Signal()
+        wr_accept = Signal()
+        rd_accept = Signal()
+        self.comb += [
+            rq_fifo.din_address.eq(slave.address),
+            rq_fifo.din_burstcount.eq(slave.burstcount),
+            rq_fifo.check_address.eq(slave.address),
+            rq_fifo.check_burstcount.eq(slave.burstcount),
+            rd_accept.eq(slave.read & rq_fifo.writable),
+            rq_fifo.we.eq(rd_accept),
+
+            wr_first.eq(wr_beats == 0),
+            wr_accept.eq(slave.write & wdata.writable &
+                (~wr_first | (wq_fifo.writable & ~rq_fifo.check_hit))),
+            wdata.we.eq(wr_accept),
+            wdata.din.eq(Cat(slave.writedata, slave.byteenable)),
+            wq_fifo.we.eq(wr_accept & wr_first),
+            wq_fifo.din_address.eq(slave.address),
+            wq_fifo.din_burstcount.eq(slave.burstcount),
+
+            slave.waitrequest.eq(~(rd_accept | wr_accept)),
+            slave.readdata.eq(master.readdata),
+            slave.readdatavalid.eq(master.readdatavalid),
+        ]
+        self.sync += If(wr_accept,
+            If(wr_first,
+                wr_beats.eq(slave.burstcount - 1)
+            ).Else(
+                wr_beats.eq(wr_beats - 1)
+            )
+        )
+
+        # Master side.
+        rd_hazard   = Signal()
+        rd_stalled  = Signal()
+        wr_stalled  = Signal()
+        wr_pressure = Signal()
+        wr_beat     = Signal()
+        wr_count    = Signal(8)
+        wr_last     = Signal()
+        in_burst    = Signal()
+        self.comb += [
+            wq_fifo.check_address.eq(rq_fifo.dout_address),
+            wq_fifo.check_burstcount.eq(rq_fifo.dout_burstcount),
+            rd_hazard.eq(rq_fifo.readable & wq_fifo.check_hit),
+            wr_pressure.eq((wdata.level >= wq_hi) | ~wq_fifo.writable | ~wdata.writable),
+            rq_fifo.re.eq(master.read & ~master.waitrequest),
+            wr_beat.eq(master.write & ~master.waitrequest),
+            wr_last.eq(wr_count == (wq_fifo.dout_burstcount - 1)),
+            wdata.re.eq(wr_beat),
+            wq_fifo.re.eq(wr_beat & wr_last),
+        ]
+        self.sync += [
+            rd_stalled.eq(master.read & master.waitrequest),
+            wr_stalled.eq(master.write & master.waitrequest),
+            If(wr_beat,
+                in_burst.eq(~wr_last),
+                If(wr_last,
+                    wr_count.eq(0)
+                ).Else(
+                    wr_count.eq(wr_count + 1)
+                )
+            )
+        ]
+
+        self.fsm = fsm = FSM(reset_state="SERVE_READ")
+        fsm.act("SERVE_READ",
+            If(wq_fifo.readable & (wr_pressure | ~rq_fifo.readable | rd_hazard),
+                # A read that has already been presented is held until it is accepted.
+                master.read.eq(rd_stalled),
+                If(~rd_stalled,
+                    NextState("SERVE_WRITE")
+                )
+            ).Else(
+                master.read.eq(rq_fifo.readable & ~rd_hazard),
+            ),
+            master.address.eq(rq_fifo.dout_address),
+            master.burstcount.eq(rq_fifo.dout_burstcount),
+            master.byteenable.eq(2**len(master.byteenable) - 1),
+        )
+        fsm.act("SERVE_WRITE",
+            # Bursts are always completed, reads are served again between two bursts.
+            If(~in_burst & (~wq_fifo.readable |
+                (rq_fifo.readable & ~rd_hazard & ~wr_pressure & (wdata.level <= wq_lo))),
+                # A write that has already been presented is held until it is accepted.
+                master.write.eq(wr_stalled),
+                If(~wr_stalled,
+                    NextState("SERVE_READ")
+                )
+            ).Else(
+                master.write.eq(wdata.readable),
+            ),
+            master.address.eq(wq_fifo.dout_address),
+            master.burstcount.eq(wq_fifo.dout_burstcount),
+            master.writedata.eq(wdata.dout[:data_width]),
+            master.byteenable.eq(wdata.dout[data_width:]),
+        )
+
+# Avalon Read Coalescer ----------------------------------------------------------------------------
+
+class AvalonReadCoalescer(LiteXModule):
+    """Serves single-beat Avalon-MM reads from a small buffer of lines.
+
+    A single-beat read that misses fetches the whole aligned line of ``window`` beats in one burst,
+    into the next one of ``lines`` line slots. Fetches are pipelined: hits and misses to other lines
+    are accepted while earlier lines are still on their way, up to ``max_outstanding`` unanswered
+    reads, and every read is answered in order as soon as its beat has arrived. Burst reads and
+    writes are passed through, a write invalidates the lines it overlaps.
+    """
+    def __init__(self, adr_width, data_width, window=8, lines=4, max_outstanding=16):
+        assert window & (window - 1) == 0 and 1 < window < 256
+        assert lines  & (lines  - 1) == 0 and 1 < lines
+        self.slave  = slave  = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+        self.master = master = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+
+        # # #
+
+        offset_bits = log2_int(window)
+        slot_bits   = log2_int(lines)
+
+        # Line buffer.
+        buf    = Memory(data_width, lines*window)
+        buf_wr = buf.get_port(write_capable=True)
+        buf_rd = buf.get_port()
+        self.specials += buf, buf_wr, buf_rd
+
+        tag        = [Signal(adr_width - offset_bits)  for _ in range(lines)]
+        valid      = [Signal()                         for _ in range(lines)]
+        filling    = [Signal()                         for _ in range(lines)]
+        fill_beats = [Signal(max=window + 1)           for _ in range(lines)]
+        refs       = [Signal(max=max_outstanding + 1)  for _ in range(lines)]
+
+        # Reads accepted from the slave, in order: one beat of a line slot or a passed-through burst.
+        self.resp_queue = resp_queue = SyncFIFO(1 + slot_bits + offset_bits, max_outstanding)
+        # Reads issued to the master, in order: a line fetch or a passed-through burst.
+        self.ret_queue  = ret_queue  = SyncFIFO(1 + slot_bits + 8, lines + 1)
+
+        # Slave side.
+        single     = Signal()
+        slave_tag  = Signal(adr_width - offset_bits)
+        hit        = Signal()
+        hit_slot   = Signal(slot_bits)
+        alloc      = Signal(slot_bits)
+        alloc_free = Signal()
+        push       = Signal()
+        push_slot  = Signal(slot_bits)
+        accepted   = Signal()
+        self.comb += [
+            single.eq(slave.read & (slave.burstcount == 1)),
+            slave_tag.eq(slave.address[offset_bits:]),
+            alloc_free.eq(~Array(filling)[alloc] & (Array(refs)[alloc] == 0)),
+            accepted.eq((slave.read | slave.write) & ~slave.waitrequest),
+            resp_queue.din.eq(Cat(slave.address[:offset_bits], push_slot, ~single)),
+            resp_queue.we.eq(accepted & slave.read),
+            push.eq(resp_queue.we & single),
+        ]
+        for i in range(lines):
+            self.comb += If(valid[i] & (tag[i] == slave_tag),
+                hit.eq(1),
+                hit_slot.eq(i),
+            )
+        self.comb += [
+            If(single & hit,
+                push_slot.eq(hit_slot),
+                slave.waitrequest.eq(~resp_queue.writable),
+            ).Elif(single,
+                # Fetch the line into the next slot, once it is neither filling nor referenced.
+                push_slot.eq(alloc),
+                master.read.eq(alloc_free & resp_queue.writable & ret_queue.writable),
+                master.address.eq(Cat(Replicate(0, offset_bits), slave_tag)),
+                master.burstcount.eq(window),
+                master.byteenable.eq(2**len(master.byteenable) - 1),
+                slave.waitrequest.eq(~master.read | master.waitrequest),
+                ret_queue.din.eq(Cat(alloc, 0, window)),
+                ret_queue.we.eq(accepted),
+            ).Elif(slave.read,
+                # Burst data goes straight back to the slave, so all earlier reads are answered first.
+                slave.connect(master, omit={"read", "readdata", "readdatavalid", "waitrequest"}),
+                master.read.eq(~resp_queue.readable & ret_queue.writable),
+                slave.waitrequest.eq(~master.read | master.waitrequest),
+                ret_queue.din.eq(Cat(Replicate(0, slot_bits), 1, slave.burstcount)),
+                ret_queue.we.eq(accepted),
+            ).Else(
+                slave.connect(master, omit={"readdata", "readdatavalid"}),
+            )
+        ]
+        self.sync += If(accepted & single & ~hit,
+            alloc.eq(alloc + 1)
+        )
+
+        # Master side.
+        ret_slot   = Signal(slot_bits)
+        ret_bypass = Signal()
+        ret_count  = Signal(8)
+        ret_beat   = Signal(8)
+        ret_last   = Signal()
+        self.comb += [
+            Cat(ret_slot, ret_bypass, ret_count).eq(ret_queue.dout),
+            ret_last.eq(master.readdatavalid & (ret_beat == (ret_count - 1))),
+            ret_queue.re.eq(ret_last),
+            buf_wr.adr.eq(Cat(ret_beat[:offset_bits], ret_slot)),
+            buf_wr.dat_w.eq(master.readdata),
+            buf_wr.we.eq(master.readdatavalid & ~ret_bypass),
+        ]
+        self.sync += If(master.readdatavalid,
+            If(ret_last,
+                ret_beat.eq(0)
+            ).Else(
+                ret_beat.eq(ret_beat + 1)
+            )
+        )
+
+        # Responses.
+        head_slot   = Signal(slot_bits)
+        head_offset = Signal(offset_bits)
+        head_bypass = Signal()
+        resp        = Signal()
+        resp_valid  = Signal()
+        self.comb += [
+            Cat(head_offset, head_slot, head_bypass).eq(resp_queue.dout),
+            buf_rd.adr.eq(Cat(head_offset, head_slot)),
+            resp.eq(resp_queue.readable & ~head_bypass & (Array(fill_beats)[head_slot] > head_offset)),
+            # A passed-through burst leaves the queue with its last beat.
+            resp_queue.re.eq(resp | (ret_last & ret_bypass)),
+            slave.readdata.eq(Mux(resp_valid, buf_rd.dat_r, master.readdata)),
+            slave.readdatavalid.eq(resp_valid | (master.readdatavalid & ret_bypass)),
+        ]
+        self.sync += resp_valid.eq(resp)
+
+        # Slot bookkeeping.
+        for i in range(lines):
+            line_start = Signal(adr_width + 1)
+            allocate   = Signal()
+            self.comb += [
+                line_start.eq(Cat(Replicate(0, offset_bits), tag[i])),
+                allocate.eq(accepted & single & ~hit & (alloc == i)),
+            ]
+            self.sync += [
+                If(allocate,
+                    tag[i].eq(slave_tag),
+                    valid[i].eq(1),
+                ).Elif(accepted & slave.write &
+                    (slave.address < (line_start + window)) &
+                    (line_start < (slave.address + slave.burstcount)),
+                    valid[i].eq(0),
+                ),
+                If(allocate,
+                    filling[i].eq(1),
+                    fill_beats[i].eq(0),
+                ).Elif(master.readdatavalid & ~ret_bypass & (ret_slot == i),
+                    fill_beats[i].eq(fill_beats[i] + 1),
+                    If(ret_last,
+                        filling[i].eq(0)
+                    )
+                ),
+                refs[i].eq(refs[i]
+                    + (push & (push_slot == i))
+                    - (resp & (head_slot == i))),
+            ]
+
+# Avalon Clock Domain Crossing ---------------------------------------------------------------------
+
+class AvalonMMClockDomainCrossing(LiteXModule):
+    """Connects an Avalon-MM master in ``cd_from`` to a slave in ``cd_to``.
+
+    Reads and write beats cross in one asynchronous FIFO, read data comes back in another one. Read
+    data can't be held back, so a read is only let through when the beats of all outstanding reads,
+    its own included, fit into the read data FIFO. While ``cd_to`` is in reset (e.g. while the DDR3
+    controller calibrates) nothing is accepted: the FIFOs are held in reset then and would drop it.
+    """
+    def __init__(self, adr_width, data_width, cd_from="sys", cd_to="avalon", cmd_depth=16, rdata_depth=256):
+        assert rdata_depth >= 255
+        self.slave  = slave  = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+        self.master = master = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+
+        # # #
+
+        cmd_layout = [
+            ("read",                     1),
+            ("write",                    1),
+            ("address",          adr_width),
+            ("burstcount",               8),
+            ("byteenable", data_width // 8),
+            ("writedata",       data_width),
+        ]
+        self.cmd = cmd = stream.ClockDomainCrossing(cmd_layout,
+            cd_from         = cd_from,
+            cd_to           = cd_to,
+            depth           = cmd_depth,
+            with_common_rst = True)
+        self.rdata = rdata = stream.ClockDomainCrossing([("data", data_width)],
+            cd_from         = cd_to,
+            cd_to           = cd_from,
+            depth           = rdata_depth,
+            buffered        = True,
+            with_common_rst = True)
+
+        # Slave side.
+        # One stage more than the reset synchronizers of the FIFOs, so that cd_to is only seen out
+        # of reset once the write side of the command FIFO is.
+        to_ready = Signal()
+        self.specials += MultiReg(~ResetSignal(cd_to), to_ready, odomain=cd_from, n=3)
+
+        rd_beats   = Signal(max=rdata_depth + 1)
+        rd_allowed = Signal()
+        self.comb += [
+            rd_allowed.eq((rd_beats + slave.burstcount) <= rdata_depth),
+            cmd.sink.valid.eq(to_ready & (slave.write | (slave.read & rd_allowed))),
+            cmd.sink.read.eq(slave.read),
+            cmd.sink.write.eq(slave.write),
+            cmd.sink.address.eq(slave.address),
+            cmd.sink.burstcount.eq(slave.burstcount),
+            cmd.sink.byteenable.eq(slave.byteenable),
+            cmd.sink.writedata.eq(slave.writedata),
+            slave.waitrequest.eq(~(cmd.sink.valid & cmd.sink.ready)),
+            rdata.source.ready.eq(1),
+            slave.readdatavalid.eq(rdata.source.valid),
+            slave.readdata.eq(rdata.source.data),
+        ]
+        sync_from = getattr(self.sync, cd_from)
+        sync_from += If(~to_ready,
+            rd_beats.eq(0)
+        ).Else(
+            rd_beats.eq(rd_beats
+                + Mux(slave.read & ~slave.waitrequest, slave.burstcount, 0)
+                - rdata.source.valid)
+        )
+
+        # Master side.
+        self.comb += [
+            master.read.eq(cmd.source.valid & cmd.source.read),
+            master.write.eq(cmd.source.valid & cmd.source.write),
+            master.address.eq(cmd.source.address),
+            master.burstcount.eq(cmd.source.burstcount),
+            master.byteenable.eq(cmd.source.byteenable),
+            master.writedata.eq(cmd.source.writedata),
+            cmd.source.ready.eq(~master.waitrequest),
+            rdata.sink.valid.eq(master.readdatavalid),
+            rdata.sink.data.eq(master.readdata),
+        ]
+
+# Avalon-MM to UniPHY ------------------------------------------------------------------------------
+
+class AvalonMM2UniPHY(LiteXModule):
+    """Drives the avl_* port of an Altera UniPHY DDR3 controller from an Avalon-MM slave port.
+
+    The request is registered once, which keeps the byte/data muxing off the avl_ready ->
+    waitrequest path. avl_burstbegin is only driven to keep the port Avalon compliant: the controller
+    in rtl/deca-ddr3 leaves it unconnected and counts the beats of a burst from avl_size. A read
+    burst is a single command beat, a write burst has one beat per data word, so a counter of the
+    write beats still to come tells a burst's first beat from the rest. Like Avalon's
+    beginbursttransfer it is a single cycle strobe, also when the controller is not ready.
+
+    Nothing is accepted while the domain is in reset, the registered request would be lost.
+    """
+    def __init__(self, adr_width, data_width):
+        self.slave = slave = AvalonMMInterface(data_width=data_width, adr_width=adr_width)
+
+        self.avl_ready       = Signal()
+        self.avl_burstbegin  = Signal()
+        self.avl_addr        = Signal(adr_width)
+        self.avl_rdata_valid = Signal()
+        self.avl_rdata       = Signal(data_width)
+        self.avl_wdata       = Signal(data_width)
+        self.avl_be          = Signal(data_width // 8)
+        self.avl_read_req    = Signal()
+        self.avl_write_req   = Signal()
+        self.avl_size        = Signal(8)
+
+        # # #
+
+        ce          = Signal()
+        write_beats = Signal(8)
+        self.comb += [
+            ce.eq(~ResetSignal() & (~(self.avl_read_req | self.avl_write_req) | self.avl_ready)),
+            slave.waitrequest.eq(~ce),
+            slave.readdatavalid.eq(self.avl_rdata_valid),
+            slave.readdata.eq(self.avl_rdata),
+        ]
+        self.sync += If(ce,
+            self.avl_read_req.eq(slave.read),
+            self.avl_write_req.eq(slave.write),
+            self.avl_burstbegin.eq((slave.read | slave.write) & (write_beats == 0)),
+            self.avl_addr.eq(slave.address),
+            self.avl_size.eq(slave.burstcount),
+            self.avl_be.eq(slave.byteenable),
+            self.avl_wdata.eq(slave.writedata),
+            If(slave.write,
+                If(write_beats == 0,
+                    write_beats.eq(slave.burstcount - 1)
+                ).Else(
+                    write_beats.eq(write_beats - 1)
+                )
+            )
+        ).Else(
+            self.avl_burstbegin.eq(0)
+        )
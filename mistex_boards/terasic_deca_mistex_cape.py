@@ -8,8 +8,14 @@
 
 from os.path import join
 import sys
+import subprocess
 import yaml
 
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
 from colorama import Fore, Style
 
 from migen import *
@@ -23,23 +29,66 @@ from litex.soc.cores.clock import Max10PLL
 from litex.soc.cores.spi.spi_bone import SPIBone
 
 from util import *
+from avalon import *
+
+# Quartus settings ---------------------------------------------------------------------------------
+
+QUARTUS_SETTINGS = (
+    "set_global_assignment -name TIMEQUEST_MULTICORNER_ANALYSIS OFF",
+    "set_global_assignment -name OPTIMIZE_POWER_DURING_FITTING OFF",
+    "set_global_assignment -name FINAL_PLACEMENT_OPTIMIZATION ALWAYS",
+    "set_global_assignment -name FITTER_EFFORT \"STANDARD FIT\"",
+    "set_global_assignment -name OPTIMIZATION_MODE \"HIGH PERFORMANCE EFFORT\"",
+    "set_global_assignment -name ALLOW_POWER_UP_DONT_CARE ON",
+    "set_global_assignment -name QII_AUTO_PACKED_REGISTERS \"SPARSE AUTO\"",
+    "set_global_assignment -name ROUTER_LCELL_INSERTION_AND_LOGIC_DUPLICATION ON",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_COMBO_LOGIC ON",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_EFFORT EXTRA",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_REGISTER_DUPLICATION ON",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_REGISTER_RETIMING ON",
+    "set_global_assignment -name OPTIMIZATION_TECHNIQUE SPEED",
+    "set_global_assignment -name MUX_RESTRUCTURE ON",
+    "set_global_assignment -name REMOVE_REDUNDANT_LOGIC_CELLS ON",
+    "set_global_assignment -name AUTO_DELAY_CHAINS_FOR_HIGH_FANOUT_INPUT_PINS ON",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_COMBO_LOGIC_FOR_AREA ON",
+    "set_global_assignment -name ADV_NETLIST_OPT_SYNTH_WYSIWYG_REMAP ON",
+    "set_global_assignment -name SYNTH_GATED_CLOCK_CONVERSION ON",
+    "set_global_assignment -name PRE_MAPPING_RESYNTHESIS ON",
+    "set_global_assignment -name ROUTER_CLOCKING_TOPOLOGY_ANALYSIS ON",
+    "set_global_assignment -name ECO_OPTIMIZE_TIMING ON",
+    "set_global_assignment -name PERIPHERY_TO_CORE_PLACEMENT_AND_ROUTING_OPTIMIZATION ON",
+    "set_global_assignment -name PHYSICAL_SYNTHESIS_ASYNCHRONOUS_SIGNAL_PIPELINING ON",
+    "set_global_assignment -name ALM_REGISTER_PACKING_EFFORT LOW",
+    "set_global_assignment -name OPTIMIZE_POWER_DURING_SYNTHESIS OFF",
+    "set_global_assignment -name ROUTER_REGISTER_DUPLICATION ON",
+    "set_global_assignment -name FITTER_AGGRESSIVE_ROUTABILITY_OPTIMIZATION ALWAYS",
+    "set_global_assignment -name SEED 1",
+)
+
+# CRG ----------------------------------------------------------------------------------------------
+
+class _CRG(LiteXModule):
+    def __init__(self, clk50, sys_clk_freq):
+        self.rst    = Signal()
+        self.cd_sys = ClockDomain()
+
+        # # #
+
+        self.pll = pll = Max10PLL(speedgrade="-6")
+        self.comb += pll.reset.eq(self.rst)
+        pll.register_clkin(clk50, 50e6)
+        pll.create_clkout(self.cd_sys, sys_clk_freq)
 
 # Build --------------------------------------------------------------------------------------------
 
 class Top(SoCCore):
     def __init__(self, platform) -> None:
-        sdram       = platform.request("sdram")
-        ddram       = platform.request("ddram")
-        hps_i2c     = platform.request("hps_i2c")
-        hdmi        = platform.request("hdmi")
-        hdmi_i2c    = platform.request("hdmi_i2c")
-        hdmi_i2s    = platform.request("hdmi_i2s")
-        sdcard      = platform.request("sdcard")
-        hps_spi     = platform.request("hps_spi")
-        hps_control = platform.request("hps_control")
+        sdram, ddram, hps_i2c, hdmi, hdmi_i2c, hdmi_i2s, sdcard, hps_spi, hps_control = request_many(platform,
+            "sdram", "ddram", "hps_i2c", "hdmi", "hdmi_i2c", "hdmi_i2s", "sdcard", "hps_spi", "hps_control")
 
+        btn  = platform.request_all("user_btn")
         leds = Signal(8)
-        self.comb += Cat([platform.request("user_led", l) for l in range(8)]).eq(~leds)
+        self.comb += platform.request("user_led_n").eq(~leds)
 
         clk50 = Signal()
         self.comb += clk50.eq(platform.request("clk50"))
@@ -48,7 +97,6 @@ class Top(SoCCore):
         DW = 64
         self.debug = False
 
-        self.cd_sys    = ClockDomain()
         self.cd_avalon = ClockDomain()
         sys_clk_freq   = 150e6
 
@@ -63,18 +111,34 @@ class Top(SoCCore):
         kwargs['integrated_sram_size'] = 0x0
         SoCCore.__init__(self, platform, sys_clk_freq, ident = f"LiteX SoC on MiSTeX / Terasic DECA cape", **kwargs)
 
+        # CRG --------------------------------------------------------------------------------------
+        # sys (and sys_top's DDR3 port) runs from its own PLL, the controller side of the DDR3
+        # path runs on the afi_clk of the UniPHY IP.
+        self.crg = _CRG(clk50, sys_clk_freq)
+
         avalon_clock         = Signal()
-        avalon_address       = Signal(AW)
-        avalon_byteenable    = Signal(DW//8)
-        avalon_read          = Signal()
-        avalon_readdata      = Signal(DW)
-        avalon_burstcount    = Signal(8)
-        avalon_write         = Signal()
-        avalon_writedata     = Signal(DW)
-        avalon_ready         = Signal()
-        avalon_readdatavalid = Signal()
-        avalon_burstbegin    = Signal()
-        avalon_waitrequest   = Signal()
+        avalon               = AvalonMMInterface(data_width=DW, adr_width=AW)
+
+        # DDR3 read coalescer, clock domain crossing and scheduler ---------------------------------
+        # Single-beat reads from sys_top are served from whole lines fetched in one burst, with
+        # several line fetches in flight. Reads and writes are queued separately and writes are
+        # drained in batches, so that the DDR3 bus is not turned around for every write.
+        self.read_coalescer = read_coalescer = AvalonReadCoalescer(AW, DW,
+            window          = 8,
+            lines           = 4,
+            max_outstanding = 16)
+        self.avalon_cdc = avalon_cdc = AvalonMMClockDomainCrossing(AW, DW,
+            cd_from = "sys",
+            cd_to   = "avalon")
+        self.mem_scheduler = mem_scheduler = ClockDomainsRenamer("avalon")(
+            AvalonMemScheduler(AW, DW, depth=256, wq_hi=192, wq_lo=64))
+        self.uniphy = uniphy = ClockDomainsRenamer("avalon")(AvalonMM2UniPHY(AW, DW))
+        self.comb += [
+            avalon.connect(read_coalescer.slave),
+            read_coalescer.master.connect(avalon_cdc.slave),
+            avalon_cdc.master.connect(mem_scheduler.slave),
+            mem_scheduler.master.connect(uniphy.slave),
+        ]
 
         afi_half_clk = Signal()
         afi_reset_export_n = Signal()
@@ -105,16 +169,16 @@ class Top(SoCCore):
             io_mem_dqs_n          = ddram.dqs_n,
             o_mem_odt             = ddram.odt,
 
-            o_avl_ready           = avalon_ready,
-            i_avl_burstbegin      = avalon_burstbegin,
-            i_avl_addr            = avalon_address,
-            o_avl_rdata_valid     = avalon_readdatavalid,
-            o_avl_rdata           = avalon_readdata,
-            i_avl_wdata           = avalon_writedata,
-            i_avl_be              = avalon_byteenable,
-            i_avl_read_req        = avalon_read,
-            i_avl_write_req       = avalon_write,
-            i_avl_size            = avalon_burstcount,
+            o_avl_ready           = uniphy.avl_ready,
+            i_avl_burstbegin      = uniphy.avl_burstbegin,
+            i_avl_addr            = uniphy.avl_addr,
+            o_avl_rdata_valid     = uniphy.avl_rdata_valid,
+            o_avl_rdata           = uniphy.avl_rdata,
+            i_avl_wdata           = uniphy.avl_wdata,
+            i_avl_be              = uniphy.avl_be,
+            i_avl_read_req        = uniphy.avl_read_req,
+            i_avl_write_req       = uniphy.avl_write_req,
+            i_avl_size            = uniphy.avl_size,
             o_local_init_done     = leds[5],
             o_local_cal_success   = leds[6],
             o_local_cal_fail      = leds[7],
@@ -127,12 +191,23 @@ class Top(SoCCore):
         self.specials += ddr3
 
         self.comb += [
-            avalon_burstbegin.eq(avalon_write & avalon_read),
-            avalon_waitrequest.eq(~avalon_ready),
             ClockSignal("avalon").eq(avalon_clock),
-            ClockSignal().eq(ClockSignal("avalon"))
+            ResetSignal("avalon").eq(~afi_reset_n),
         ]
 
+        # sys and afi_clk are both derived from clk50, so TimeQuest would time the paths between
+        # them as related clocks. They only meet in avalon_cdc: declare them asynchronous. sys_clk
+        # is the name derive_pll_clocks -use_net_name gives the sys PLL output (as in the
+        # litex-boards DECA target), afi_clk is named by the UniPHY SDC (ddr3_p0.sdc) after its PLL
+        # output: <pll>|clk[4]_afi_clk. A group that matches no clock would leave the crossing timed
+        # as related clocks, so that is reported as an error.
+        for clocks in ("sys_clk", "*_afi_clk"):
+            platform.toolchain.additional_sdc_commands.append(
+                f"if {{[get_collection_size [get_clocks -nowarn {{{clocks}}}]] == 0}} "
+                f"{{post_message -type error \"avalon_cdc: no clock matches {clocks}\"}}")
+        platform.toolchain.additional_sdc_commands.append(
+            "set_clock_groups -asynchronous -group [get_clocks {sys_clk}] -group [get_clocks {*_afi_clk}]")
+
         sys_top = Instance("sys_top",
             p_DW            = DW,
             p_AW            = AW,
@@ -177,9 +252,9 @@ class Top(SoCCore):
             o_LED_USER  = leds[2],
             o_LED_HDD   = leds[1],
             o_LED_POWER = leds[0],
-            # i_BTN_USER  = platform.request("user_btn", 0),
-            i_BTN_OSD   = platform.request("user_btn", 0),
-            i_BTN_RESET = platform.request("user_btn", 1),
+            # i_BTN_USER  = btn[0],
+            i_BTN_OSD   = btn[0],
+            i_BTN_RESET = btn[1],
 
             o_SD_SPI_CS   = sdcard.sel,
             i_SD_SPI_MISO = sdcard.data[0],
@@ -199,16 +274,16 @@ class Top(SoCCore):
             i_HPS_CORE_RESET = hps_control.core_reset,
             # o_DEBUG = N/C
 
-            i_ddr3_clk_i           = avalon_clock,
-            o_ddr3_address_o       = avalon_address,
-            o_ddr3_byteenable_o    = avalon_byteenable,
-            o_ddr3_read_o          = avalon_read,
-            i_ddr3_readdata_i      = avalon_readdata,
-            o_ddr3_burstcount_o    = avalon_burstcount,
-            o_ddr3_write_o         = avalon_write,
-            o_ddr3_writedata_o     = avalon_writedata,
-            i_ddr3_waitrequest_i   = avalon_waitrequest,
-            i_ddr3_readdatavalid_i = avalon_readdatavalid,
+            i_ddr3_clk_i           = ClockSignal("sys"),
+            o_ddr3_address_o       = avalon.address,
+            o_ddr3_byteenable_o    = avalon.byteenable,
+            o_ddr3_read_o          = avalon.read,
+            i_ddr3_readdata_i      = avalon.readdata,
+            o_ddr3_burstcount_o    = avalon.burstcount,
+            o_ddr3_write_o         = avalon.write,
+            o_ddr3_writedata_o     = avalon.writedata,
+            i_ddr3_waitrequest_i   = avalon.waitrequest,
+            i_ddr3_readdatavalid_i = avalon.readdatavalid,
         )
         self.specials += sys_top
 
@@ -217,31 +292,33 @@ class Top(SoCCore):
             self.submodules.spibone = spibone = SPIBone(platform.request("spibone"))
             self.add_wb_master(spibone.bus)
 
+            # LiteScope ------------------------------------------------------------------------------
+            # Probes the DDR3 controller side of the bus. Only the narrow control signals are
+            # captured (no data buses), and captures are meant to be started on the first beat
+            # of a burst: litescope_cli --rising-edge uniphy_avl_burstbegin
             from litescope import LiteScopeAnalyzer
             analyzer_signals = [
-                # DBus (could also just added as self.cpu.dbus)
-                avalon_clock,
-                avalon_address,
-                avalon_waitrequest,
-                avalon_read,
-                #avalon_readdata,
-                avalon_readdatavalid,
-                avalon_write,
-                #avalon_writedata,
-                avalon_burstcount,
-                avalon_byteenable,
+                uniphy.avl_burstbegin,
+                uniphy.avl_addr,
+                uniphy.avl_size,
+                uniphy.avl_read_req,
+                uniphy.avl_write_req,
+                uniphy.avl_ready,
+                uniphy.avl_rdata_valid,
             ]
             self.analyzer = LiteScopeAnalyzer(analyzer_signals,
-                depth        = 4096,
-                samplerate   = 150e6,
-                clock_domain = "sys",
-                csr_csv      = "analyzer.csv")
+                depth         = 1024,
+                trigger_depth = 64,
+                samplerate    = 150e6,
+                clock_domain  = "avalon",
+                csr_csv       = "analyzer.csv")
 
 
 def main(core):
     coredir = join("cores", core)
 
-    mistex_yaml = yaml.load(open(join(coredir, "MiSTeX.yaml"), 'r'), Loader=yaml.FullLoader)
+    with open(join(coredir, "MiSTeX.yaml"), 'r') as f:
+        mistex_yaml = yaml.load(f, Loader=YAMLLoader)
 
     platform = terasic_deca.Platform()
 
@@ -251,35 +328,7 @@ def main(core):
     add_mainfile(platform, coredir, mistex_yaml)
 
     platform.add_platform_command(f"set_global_assignment -name QIP_FILE {os.getcwd()}/rtl/deca-ddr3/ddr3.qip")
-    platform.add_platform_command("set_global_assignment -name TIMEQUEST_MULTICORNER_ANALYSIS OFF")
-    platform.add_platform_command("set_global_assignment -name OPTIMIZE_POWER_DURING_FITTING OFF")
-    platform.add_platform_command("set_global_assignment -name FINAL_PLACEMENT_OPTIMIZATION ALWAYS")
-    platform.add_platform_command("set_global_assignment -name FITTER_EFFORT \"STANDARD FIT\"")
-    platform.add_platform_command("set_global_assignment -name OPTIMIZATION_MODE \"HIGH PERFORMANCE EFFORT\"")
-    platform.add_platform_command("set_global_assignment -name ALLOW_POWER_UP_DONT_CARE ON")
-    platform.add_platform_command("set_global_assignment -name QII_AUTO_PACKED_REGISTERS \"SPARSE AUTO\"")
-    platform.add_platform_command("set_global_assignment -name ROUTER_LCELL_INSERTION_AND_LOGIC_DUPLICATION ON")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_COMBO_LOGIC ON")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_EFFORT EXTRA")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_REGISTER_DUPLICATION ON")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_REGISTER_RETIMING ON")
-    platform.add_platform_command("set_global_assignment -name OPTIMIZATION_TECHNIQUE SPEED")
-    platform.add_platform_command("set_global_assignment -name MUX_RESTRUCTURE ON")
-    platform.add_platform_command("set_global_assignment -name REMOVE_REDUNDANT_LOGIC_CELLS ON")
-    platform.add_platform_command("set_global_assignment -name AUTO_DELAY_CHAINS_FOR_HIGH_FANOUT_INPUT_PINS ON")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_COMBO_LOGIC_FOR_AREA ON")
-    platform.add_platform_command("set_global_assignment -name ADV_NETLIST_OPT_SYNTH_WYSIWYG_REMAP ON")
-    platform.add_platform_command("set_global_assignment -name SYNTH_GATED_CLOCK_CONVERSION ON")
-    platform.add_platform_command("set_global_assignment -name PRE_MAPPING_RESYNTHESIS ON")
-    platform.add_platform_command("set_global_assignment -name ROUTER_CLOCKING_TOPOLOGY_ANALYSIS ON")
-    platform.add_platform_command("set_global_assignment -name ECO_OPTIMIZE_TIMING ON")
-    platform.add_platform_command("set_global_assignment -name PERIPHERY_TO_CORE_PLACEMENT_AND_ROUTING_OPTIMIZATION ON")
-    platform.add_platform_command("set_global_assignment -name PHYSICAL_SYNTHESIS_ASYNCHRONOUS_SIGNAL_PIPELINING ON")
-    platform.add_platform_command("set_global_assignment -name ALM_REGISTER_PACKING_EFFORT LOW")
-    platform.add_platform_command("set_global_assignment -name OPTIMIZE_POWER_DURING_SYNTHESIS OFF")
-    platform.add_platform_command("set_global_assignment -name ROUTER_REGISTER_DUPLICATION ON")
-    platform.add_platform_command("set_global_assignment -name FITTER_AGGRESSIVE_ROUTABILITY_OPTIMIZATION ALWAYS")
-    platform.add_platform_command("set_global_assignment -name SEED 1")
+    platform.add_platform_command("\n".join(QUARTUS_SETTINGS))
 
     defines = mistex_yaml.get('defines', {})
     defines.update({
@@ -299,10 +348,12 @@ def main(core):
         "MISTER_DISABLE_ALSA": 1,
     })
 
-    for key, value in defines.items():
-        platform.add_platform_command(f'set_global_assignment -name VERILOG_MACRO "{key}={value}"')
+    platform.add_platform_command("\n".join(
+        f'set_global_assignment -name VERILOG_MACRO "{key}={value}"' for key, value in defines.items()))
 
     platform.add_extension([
+        # The eight active low user LEDs as one bus.
+        ("user_led_n", 0, Pins("C7 C8 A6 B7 C4 A5 B4 C5"), IOStandard("1.2 V")),
         ("hps_i2c", 0,
             Subsignal("sda", Pins("P9:26")),
             Subsignal("scl", Pins("P9:27")),
@@ -360,9 +411,11 @@ def main(core):
         #bios_console="lite"
     )
 
-    builder.build(build_name = get_build_name(core))
+    builder.build(build_name=build_name)
 
-    os.system(f"quartus_cpf -c -q 24.0MHz -g 3.3 -n p {build_dir}/{build_name}.sof {build_dir}/{build_name}.svf")
+    sof = join(build_dir, f"{build_name}.sof")
+    svf = join(build_dir, f"{build_name}.svf")
+    subprocess.run(["quartus_cpf", "-c", "-q", "24.0MHz", "-g", "3.3", "-n", "p", sof, svf], check=True)
 
 if __name__ == "__main__":
     handle_main(main)
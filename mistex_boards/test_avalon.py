@@ -0,0 +1,497 @@
+#
+# This file is part of MiSTeX-Boards.
+#
+# Copyright (c) 2023 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import random
+import unittest
+
+from migen import *
+from migen.sim import passive
+
+from litex.soc.interconnect.avalon import AvalonMMInterface
+
+from avalon import *
+
+AW = 10
+DW = 16
+BE = DW // 8
+
+# Helpers ------------------------------------------------------------------------------------------
+
+def gen_ops(n, seed, maxburst=8, region=64):
+    """Random mix of single-beat and burst reads and writes, clustered so that line hits and
+    read/write hazards happen."""
+    rnd = random.Random(seed)
+    ops = []
+    for _ in range(n):
+        kind  = rnd.choice("rrw" if rnd.random() < 0.5 else "rww")
+        count = rnd.choice([1, 1, 1, 2, 4, maxburst])
+        base  = rnd.randrange(region)
+        if rnd.random() < 0.5 and ops:
+            base = (ops[-1][1] + rnd.randrange(-4, 8)) % region
+        if kind == "w":
+            data = [rnd.randrange(2**DW) for _ in range(count)]
+            be   = [rnd.choice([2**BE - 1, 2**BE - 1, rnd.randrange(2**BE)]) for _ in range(count)]
+            ops.append(("w", base, count, data, be))
+        else:
+            ops.append(("r", base, count))
+    return ops
+
+def merge(old, new, be):
+    for b in range(BE):
+        if be >> b & 1:
+            mask = 0xff << (8*b)
+            old  = (old & ~mask) | (new & mask)
+    return old
+
+class Env:
+    """Avalon-MM master issuing ``ops``, a monitor collecting the read data and memory models
+    (plain Avalon-MM slave or UniPHY avl_* port) checking it against a reference."""
+    def __init__(self, ops, seed, master_idle=0.3, slave_wait=0.3, latency=(2, 12), penalty=0):
+        self.ops         = ops
+        self.rnd         = random.Random(seed)
+        self.master_idle = master_idle
+        self.slave_wait  = slave_wait
+        self.latency     = latency
+        self.penalty     = penalty
+        self.expected    = []
+        ref = {}
+        for op in ops:
+            if op[0] == "w":
+                _, a, c, d, be = op
+                for i in range(c):
+                    ref[a + i] = merge(ref.get(a + i, 0), d[i], be[i])
+            else:
+                _, a, c = op
+                self.expected += [ref.get(a + i, 0) for i in range(c)]
+        self.got      = []
+        self.done     = False
+        self.stuck    = 0
+        self.cycles   = 0
+        self.reads    = 0
+        self.writes   = 0
+        self.switches = 0
+
+    def guard(self):
+        self.stuck += 1
+        if self.stuck > 5000:
+            raise RuntimeError(f"deadlock, got {len(self.got)} of {len(self.expected)} beats")
+
+    def master(self, bus):
+        rnd = self.rnd
+        for op in self.ops:
+            while rnd.random() < self.master_idle:
+                yield
+            beats = op[2] if op[0] == "w" else 1
+            for i in range(beats):
+                yield bus.read.eq(op[0] == "r")
+                yield bus.write.eq(op[0] == "w")
+                yield bus.address.eq(op[1])
+                yield bus.burstcount.eq(op[2])
+                if op[0] == "w":
+                    yield bus.writedata.eq(op[3][i])
+                    yield bus.byteenable.eq(op[4][i])
+                else:
+                    yield bus.byteenable.eq(2**BE - 1)
+                yield
+                while (yield bus.waitrequest):
+                    yield
+                    self.guard()
+                yield bus.read.eq(0)
+                yield bus.write.eq(0)
+                self.stuck = 0
+        for _ in range(5000):
+            if len(self.got) == len(self.expected):
+                break
+            yield
+        self.done = True
+
+    @passive
+    def monitor(self, bus):
+        while True:
+            if (yield bus.readdatavalid):
+                self.got.append((yield bus.readdata))
+            yield
+
+    @passive
+    def slave(self, bus):
+        """Avalon-MM memory with random waitrequest and read latency. A read/write turnaround
+        stalls the next command for ``penalty`` cycles."""
+        rnd     = self.rnd
+        mem     = {}
+        pending = []
+        wr_left = wr_addr = wr_idx = 0
+        last    = None
+        stall   = 0
+        held    = None
+        cycle   = 0
+        while True:
+            cycle += 1
+            self.cycles = cycle
+            wait = (yield bus.waitrequest)
+            rd   = (yield bus.read)
+            wr   = (yield bus.write)
+            assert not (rd and wr)
+            # A request has to be held unchanged while waitrequest is asserted.
+            request = (rd, wr, (yield bus.address), (yield bus.burstcount), (yield bus.byteenable),
+                (yield bus.writedata) if wr else None)
+            if held is not None:
+                assert request == held, f"request changed under waitrequest: {held} -> {request}"
+            held = request if wait and (rd or wr) else None
+            if not wait and rd:
+                assert wr_left == 0, "read during write burst"
+                assert (yield bus.byteenable) != 0, "read without byteenable"
+                a, c = (yield bus.address), (yield bus.burstcount)
+                self._queue_read(pending, cycle, a, c)
+                self.reads += 1
+                if last == "w":
+                    self.switches += 1
+                    stall = self.penalty
+                last = "r"
+            if not wait and wr:
+                if wr_left == 0:
+                    wr_addr, wr_left, wr_idx = (yield bus.address), (yield bus.burstcount), 0
+                    self.writes += 1
+                    if last == "r":
+                        self.switches += 1
+                        stall = self.penalty
+                    last = "w"
+                else:
+                    assert (yield bus.address) == wr_addr
+                a = wr_addr + wr_idx
+                mem[a] = merge(mem.get(a, 0), (yield bus.writedata), (yield bus.byteenable))
+                wr_idx  += 1
+                wr_left -= 1
+            yield from self._return_read(pending, mem, cycle, bus.readdatavalid, bus.readdata)
+            stall_now = stall > 0 and wr_left == 0
+            if stall_now:
+                stall -= 1
+            yield bus.waitrequest.eq(stall_now or rnd.random() < self.slave_wait)
+            yield
+
+    @passive
+    def uniphy(self, phy, calibration=0):
+        """UniPHY avl_* port: avl_ready stays low for ``calibration`` cycles, avl_burstbegin has
+        to strobe on the first cycle the first beat of a burst is presented."""
+        rnd     = self.rnd
+        mem     = {}
+        pending = []
+        wr_left = wr_addr = wr_idx = 0
+        stalled = False
+        held    = None
+        cycle   = 0
+        while True:
+            cycle += 1
+            self.cycles = cycle
+            ready = (yield phy.avl_ready)
+            rd    = (yield phy.avl_read_req)
+            wr    = (yield phy.avl_write_req)
+            bb    = (yield phy.avl_burstbegin)
+            assert not (rd and wr)
+            # A request has to be held unchanged while avl_ready is low.
+            request = (rd, wr, (yield phy.avl_addr), (yield phy.avl_size), (yield phy.avl_be),
+                (yield phy.avl_wdata) if wr else None)
+            if held is not None:
+                assert request == held, f"request changed while not ready: {held} -> {request}"
+            held = request if (rd or wr) and not ready else None
+            if (rd or wr) and not stalled:
+                assert bb == (wr_left == 0), f"avl_burstbegin={bb} at cycle {cycle}"
+            else:
+                assert not bb, f"avl_burstbegin held at cycle {cycle}"
+            if ready and rd:
+                assert wr_left == 0, "read during write burst"
+                self._queue_read(pending, cycle, (yield phy.avl_addr), (yield phy.avl_size))
+                self.reads += 1
+            if ready and wr:
+                if wr_left == 0:
+                    wr_addr, wr_left, wr_idx = (yield phy.avl_addr), (yield phy.avl_size), 0
+                    self.writes += 1
+                a = wr_addr + wr_idx
+                mem[a] = merge(mem.get(a, 0), (yield phy.avl_wdata), (yield phy.avl_be))
+                wr_idx  += 1
+                wr_left -= 1
+            stalled = (rd or wr) and not ready
+            yield from self._return_read(pending, mem, cycle, phy.avl_rdata_valid, phy.avl_rdata)
+            yield phy.avl_ready.eq(cycle > calibration and rnd.random() >= self.slave_wait)
+            yield
+
+    def _queue_read(self, pending, cycle, address, count):
+        assert count >= 1
+        t      = cycle + self.rnd.randint(*self.latency)
+        last_t = pending[-1][0] if pending else 0
+        for i in range(count):
+            t = max(t, last_t + 1)
+            last_t = t
+            pending.append([t, None, address + i])
+
+    def _return_read(self, pending, mem, cycle, valid, data):
+        # Reads sample the memory in order with the writes accepted before them.
+        for p in pending:
+            if p[1] is None:
+                p[1] = mem.get(p[2], 0)
+        if pending and pending[0][0] <= cycle + 1:
+            yield valid.eq(1)
+            yield data.eq(pending.pop(0)[1])
+        else:
+            yield valid.eq(0)
+
+    def check(self, test):
+        test.assertTrue(self.done, "timeout")
+        test.assertEqual(len(self.got), len(self.expected))
+        for i, (got, expected) in enumerate(zip(self.got, self.expected)):
+            test.assertEqual(got, expected, f"beat {i}")
+
+class _PassThrough(Module):
+    def __init__(self):
+        self.slave  = AvalonMMInterface(data_width=DW, adr_width=AW)
+        self.master = AvalonMMInterface(data_width=DW, adr_width=AW)
+        self.comb  += self.slave.connect(self.master)
+
+def cdc_clocks(cdc, clocks):
+    """``clocks`` of sys and avalon, plus the ones of the intermediate domains the with_common_rst
+    stream.ClockDomainCrossings of ``cdc`` run in. The simulator only clocks the domains it is
+    given, the common reset reaches them through its AsyncResetSynchronizer model."""
+    return {**clocks,
+        f"from{cdc.cmd.duid}":   clocks["sys"],
+        f"to{cdc.cmd.duid}":     clocks["avalon"],
+        f"from{cdc.rdata.duid}": clocks["avalon"],
+        f"to{cdc.rdata.duid}":   clocks["sys"],
+    }
+
+# Read Coalescer -----------------------------------------------------------------------------------
+
+class TestAvalonReadCoalescer(unittest.TestCase):
+    def run_ops(self, dut, ops, seed, **kwargs):
+        env = Env(ops, seed, **kwargs)
+        run_simulation(dut, [env.master(dut.slave), env.monitor(dut.slave), env.slave(dut.master)])
+        env.check(self)
+        return env
+
+    def test_random_traffic(self):
+        configs = [
+            dict(window=8),
+            dict(window=4),
+            dict(window=8, lines=2, max_outstanding=2),
+            dict(window=4, lines=8, max_outstanding=16),
+        ]
+        for seed in range(2):
+            for config in configs:
+                with self.subTest(seed=seed, **config):
+                    dut = AvalonReadCoalescer(AW, DW, **config)
+                    self.run_ops(dut, gen_ops(200, seed, region=200), seed, master_idle=0.1, penalty=6)
+
+    def test_line_hits(self):
+        # Eight single-beat reads of one line: one line fetch.
+        ops = [("r", 16 + i, 1) for i in range(8)]
+        env = self.run_ops(AvalonReadCoalescer(AW, DW, window=8), ops, 0)
+        self.assertEqual(env.reads, 1)
+
+    def test_write_invalidates_line(self):
+        ops = [("r", 16, 1), ("w", 17, 1, [0x1234], [2**BE - 1]), ("r", 17, 1), ("r", 18, 1)]
+        env = self.run_ops(AvalonReadCoalescer(AW, DW, window=8), ops, 0)
+        self.assertEqual(env.reads, 2)
+
+    def test_bursts_pass_through(self):
+        ops = [("r", 3, 1), ("r", 8, 4), ("r", 4, 1), ("r", 40, 8)]
+        env = self.run_ops(AvalonReadCoalescer(AW, DW, window=8), ops, 0)
+        self.assertEqual(env.reads, 3)
+
+    def test_sequential_scan(self):
+        # 256 single-beat reads, 10-14 cycles of latency: line fetches have to overlap to be
+        # faster than passing every read through.
+        ops    = [("r", a, 1) for a in range(256)]
+        kwargs = dict(master_idle=0.0, slave_wait=0.1, latency=(10, 14))
+        wire   = self.run_ops(_PassThrough(), ops, 1, **kwargs)
+        dut    = self.run_ops(AvalonReadCoalescer(AW, DW, window=8), ops, 1, **kwargs)
+        self.assertEqual(dut.reads, 32)
+        self.assertLess(dut.cycles, wire.cycles)
+
+# Memory Scheduler ---------------------------------------------------------------------------------
+
+class TestAvalonMemScheduler(unittest.TestCase):
+    def run_ops(self, dut, ops, seed, **kwargs):
+        env = Env(ops, seed, **kwargs)
+        run_simulation(dut, [env.master(dut.slave), env.monitor(dut.slave), env.slave(dut.master)])
+        env.check(self)
+        return env
+
+    def test_random_traffic(self):
+        configs = [
+            dict(depth=64, wq_hi=48, wq_lo=8, wq_depth=8, rq_depth=4),
+            dict(depth=16, wq_hi=8,  wq_lo=0, wq_depth=2, rq_depth=2),
+        ]
+        for seed in range(3):
+            for config in configs:
+                with self.subTest(seed=seed, **config):
+                    # A small region makes read-after-write and write-after-read hazards frequent.
+                    ops = gen_ops(200, seed, region=900 if seed % 2 else 60)
+                    self.run_ops(AvalonMemScheduler(AW, DW, **config), ops, seed,
+                        master_idle=0.05 if seed % 3 else 0.5, penalty=6)
+
+    def test_write_batching(self):
+        # Alternating reads and writes to disjoint addresses: writes are drained in batches.
+        ops = []
+        for i in range(100):
+            ops.append(("r", i, 1))
+            ops.append(("w", 512 + i, 1, [i], [2**BE - 1]))
+        kwargs = dict(master_idle=0.0, slave_wait=0.0, penalty=6)
+        wire   = self.run_ops(_PassThrough(), ops, 0, **kwargs)
+        dut    = self.run_ops(AvalonMemScheduler(AW, DW, depth=64, wq_hi=48, wq_lo=8), ops, 0, **kwargs)
+        self.assertLess(2*dut.switches, wire.switches)
+        self.assertLess(dut.cycles, wire.cycles)
+
+# Clock Domain Crossing ----------------------------------------------------------------------------
+
+class _CDCDUT(Module):
+    def __init__(self, rdata_depth=256):
+        self.clock_domains.cd_sys    = ClockDomain()
+        self.clock_domains.cd_avalon = ClockDomain()
+        self.submodules.cdc = cdc = AvalonMMClockDomainCrossing(AW, DW, "sys", "avalon",
+            cmd_depth   = 4,
+            rdata_depth = rdata_depth)
+        self.slave  = cdc.slave
+        self.master = cdc.master
+
+class TestAvalonMMClockDomainCrossing(unittest.TestCase):
+    def run_ops(self, ops, seed, clocks, avalon_reset=0, **kwargs):
+        dut      = _CDCDUT()
+        env      = Env(ops, seed, **kwargs)
+        accepted = []
+
+        def reset():
+            yield dut.cd_avalon.rst.eq(1)
+            for _ in range(avalon_reset):
+                yield
+            yield dut.cd_avalon.rst.eq(0)
+
+        @passive
+        def watch():
+            while True:
+                request = (yield dut.slave.read) | (yield dut.slave.write)
+                if (yield dut.cd_avalon.rst) and request and not (yield dut.slave.waitrequest):
+                    accepted.append(1)
+                yield
+
+        generators = {
+            "sys":    [env.master(dut.slave), env.monitor(dut.slave), watch()],
+            "avalon": [env.slave(dut.master), reset()],
+        }
+        run_simulation(dut, generators, clocks=cdc_clocks(dut.cdc, clocks))
+        env.check(self)
+        self.assertEqual(accepted, [])
+        return env
+
+    def test_random_traffic(self):
+        for clocks in ({"sys": 10, "avalon": 7}, {"sys": 7, "avalon": 13}, {"sys": 23, "avalon": 5}):
+            with self.subTest(clocks=clocks):
+                self.run_ops(gen_ops(150, 1, region=120), 1, clocks, master_idle=0.1, penalty=3)
+
+    def test_read_credits(self):
+        # Long bursts from a slow sys side: without read credits the read data FIFO overflows.
+        ops = [("r", 64*i, 128) for i in range(6)]
+        self.run_ops(ops, 2, {"sys": 23, "avalon": 5}, master_idle=0.0, slave_wait=0.0, latency=(1, 2))
+
+    def test_avalon_reset(self):
+        # Nothing may be accepted while the controller side is in reset.
+        self.run_ops(gen_ops(60, 3, region=120), 3, {"sys": 10, "avalon": 7}, avalon_reset=100,
+            master_idle=0.0)
+
+# UniPHY -------------------------------------------------------------------------------------------
+
+class _UniPHYDUT(Module):
+    def __init__(self):
+        self.clock_domains.cd_sys = ClockDomain()
+        self.submodules.phy = AvalonMM2UniPHY(AW, DW)
+        self.slave = self.phy.slave
+
+class TestAvalonMM2UniPHY(unittest.TestCase):
+    def run_ops(self, ops, seed, reset=0, calibration=0, **kwargs):
+        dut      = _UniPHYDUT()
+        env      = Env(ops, seed, **kwargs)
+        accepted = []
+
+        def reset_gen():
+            yield dut.cd_sys.rst.eq(1)
+            for _ in range(reset):
+                yield
+            yield dut.cd_sys.rst.eq(0)
+
+        @passive
+        def watch():
+            while True:
+                request = (yield dut.slave.read) | (yield dut.slave.write)
+                if (yield dut.cd_sys.rst) and request and not (yield dut.slave.waitrequest):
+                    accepted.append(1)
+                yield
+
+        generators = [env.master(dut.slave), env.monitor(dut.slave), env.uniphy(dut.phy, calibration),
+            reset_gen(), watch()]
+        run_simulation(dut, generators)
+        env.check(self)
+        self.assertEqual(accepted, [])
+        return env
+
+    def test_random_traffic(self):
+        for seed in range(2):
+            for wait in (0.0, 0.3, 0.7):
+                with self.subTest(seed=seed, wait=wait):
+                    self.run_ops(gen_ops(200, seed, maxburst=16), seed, slave_wait=wait, master_idle=0.2)
+
+    def test_reset_during_calibration(self):
+        self.run_ops(gen_ops(100, 4), 4, reset=50, calibration=200, master_idle=0.0)
+
+# Full DDR3 path -----------------------------------------------------------------------------------
+
+class _DDR3PathDUT(Module):
+    def __init__(self):
+        self.clock_domains.cd_sys    = ClockDomain()
+        self.clock_domains.cd_avalon = ClockDomain()
+        self.submodules.coalescer = coalescer = AvalonReadCoalescer(AW, DW, window=8)
+        self.submodules.cdc       = cdc       = AvalonMMClockDomainCrossing(AW, DW, "sys", "avalon",
+            cmd_depth = 4)
+        self.submodules.scheduler = scheduler = ClockDomainsRenamer("avalon")(
+            AvalonMemScheduler(AW, DW, depth=32, wq_hi=16, wq_lo=4))
+        self.submodules.phy       = phy       = ClockDomainsRenamer("avalon")(AvalonMM2UniPHY(AW, DW))
+        self.comb += [
+            coalescer.master.connect(cdc.slave),
+            cdc.master.connect(scheduler.slave),
+            scheduler.master.connect(phy.slave),
+        ]
+        self.slave = coalescer.slave
+
+class TestDDR3Path(unittest.TestCase):
+    def run_ops(self, ops, seed, avalon_reset=0, calibration=0, **kwargs):
+        dut = _DDR3PathDUT()
+        env = Env(ops, seed, **kwargs)
+
+        def reset():
+            yield dut.cd_avalon.rst.eq(1)
+            for _ in range(avalon_reset):
+                yield
+            yield dut.cd_avalon.rst.eq(0)
+
+        generators = {
+            "sys":    [env.master(dut.slave), env.monitor(dut.slave)],
+            "avalon": [env.uniphy(dut.phy, calibration), reset()],
+        }
+        run_simulation(dut, generators, clocks=cdc_clocks(dut.cdc, {"sys": 10, "avalon": 7}))
+        env.check(self)
+        return env
+
+    def test_random_traffic(self):
+        for seed in range(2):
+            with self.subTest(seed=seed):
+                self.run_ops(gen_ops(150, seed, region=120), seed, master_idle=0.1)
+
+    def test_reset_during_calibration(self):
+        # sys_top starts issuing requests while the controller is still in reset and calibrating.
+        for seed in range(2):
+            with self.subTest(seed=seed):
+                self.run_ops(gen_ops(150, seed, region=120), seed, avalon_reset=100, calibration=300,
+                    master_idle=0.1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -85,3 +85,6 @@ def get_build_dir(core):
 
 def get_build_name(core):
     return core.replace("-", "_") + "_MiSTeX"
+
+def request_many(platform, *names):
+    return [platform.request(name) for name in names]